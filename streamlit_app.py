@@ -3,78 +3,206 @@
 import streamlit as st
 import openai
 import fitz  # PyMuPDF
-import json
+import orjson
 import openpyxl
-from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter, column_index_from_string
 from io import BytesIO
 import re
+import hashlib
+import os
+import zipfile
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
+import diskcache
+import tiktoken
 
 # ---- SETTINGS ----
-openai.api_key = st.secrets["OPENAI"]["OPENAI_API_KEY"]  # Add in Streamlit secrets or replace directly
+OPENAI_API_KEY = st.secrets["OPENAI"]["OPENAI_API_KEY"]  # Add in Streamlit secrets or replace directly
 TEMPLATE_PATH = "TJC Practice Simple Model New (7) (2).xlsx"  # Replace with your Excel LBO model
+LLM_CACHE_DIR = "/tmp/llm_cache"  # Survives Streamlit reruns and restarts
+LLM_CACHE_TTL = 86400  # Seconds
+LLM_CACHE_MAX_TEMPERATURE = 0.1  # Only near-deterministic calls are worth caching
+LBO_MODEL = os.getenv("LBO_MODEL", "gpt-4o-mini")  # Override per deployment if fidelity regresses
+EXTRACTION_MAX_TOKENS = 1000  # Bounds generation latency; ~30 metric/year entries fit comfortably
+MAX_LISTED_ISSUES = 100  # Per warning box, so a pathological extraction can't flood the page
+PROMPT_HEADER_CHARS = 500  # Leading text kept verbatim for company name / units context
+PROMPT_MAX_TOKENS = 2000  # Budget for the condensed CIM text sent to GPT
+
+# ---- LLM CACHE ----
+class LLMCache:
+    """Exact-match on-disk cache for GPT responses, keyed on (model, messages, temperature)"""
+
+    def __init__(self, directory):
+        self.store = diskcache.Cache(directory)
+
+    @staticmethod
+    def normalize(messages):
+        """Collapse whitespace so re-flowed copies of the same CIM text share a key"""
+        return [{**m, "content": " ".join(m["content"].split())} for m in messages]
+
+    @classmethod
+    def make_key(cls, model, messages, temperature):
+        payload = orjson.dumps(
+            {"model": model, "messages": cls.normalize(messages), "temperature": temperature},
+            option=orjson.OPT_SORT_KEYS,
+        )
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, model, messages, temperature):
+        if temperature > LLM_CACHE_MAX_TEMPERATURE:
+            return None
+        return self.store.get(self.make_key(model, messages, temperature))
+
+    def set(self, model, messages, temperature, value):
+        if temperature > LLM_CACHE_MAX_TEMPERATURE:
+            return
+        self.store.set(self.make_key(model, messages, temperature), value, expire=LLM_CACHE_TTL)
+
+@st.cache_resource
+def get_llm_cache():
+    return LLMCache(LLM_CACHE_DIR)
+
+@st.cache_resource
+def get_openai_client(api_key):
+    # One client per process so its HTTP connection pool survives reruns
+    return openai.OpenAI(api_key=api_key)
 
 # ---- UTILS ----
-def extract_text_from_pdf(uploaded_file):
-    pdf = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-    full_text = ""
-    for page in pdf:
-        full_text += page.get_text()
-    return full_text
-
-def clean_json_response(response_text):
-    """Clean and extract JSON from GPT response"""
-    # Remove markdown code blocks if present
-    response_text = re.sub(r'```json\n?', '', response_text)
-    response_text = re.sub(r'```\n?', '', response_text)
-    
-    # Find JSON-like content between curly braces
-    json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-    if json_match:
-        return json_match.group(0)
+@st.cache_data(show_spinner=False)
+def extract_text_from_pdf(file_key, _file_bytes):
+    """Parse the PDF once per unique upload; reruns hit the cache via the SHA-256 key"""
+    with fitz.open(stream=_file_bytes, filetype="pdf") as pdf:
+        return "".join(page.get_text("text") for page in pdf)
+
+_FINANCIAL_LINE = re.compile(
+    r'(?:19|20)\d{2}|EBITDA|Revenue|Capex|Maintenance|Acquisition|\$[\d,]+|\d%',
+    re.IGNORECASE,
+)
+
+@st.cache_resource
+def get_token_encoding(model):
+    """Tokenizer for prompt budgeting, or None if its BPE file can't be fetched"""
+    try:
+        name = tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        name = "o200k_base"
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception:
+        # tiktoken downloads the BPE file on first use; offline we budget by characters
+        return None
+
+def condense_financial_text(raw_text, max_tokens=PROMPT_MAX_TOKENS, header_chars=PROMPT_HEADER_CHARS):
+    """Keep the header plus lines that look financial (with one line of context either side)"""
+    lines = raw_text.splitlines()
+    keep = set()
+    for i, line in enumerate(lines):
+        if _FINANCIAL_LINE.search(line):
+            keep.update((i - 1, i, i + 1))
+    body = "\n".join(lines[i] for i in sorted(keep) if 0 <= i < len(lines))
     
-    return response_text.strip()
+    # Budget by tokens, which is what GPT bills and scales latency by. Pre-trim
+    # generously by characters so a huge CIM isn't tokenized in full.
+    text = (raw_text[:header_chars] + "\n...\n" + body)[:max_tokens * 8]
+    encoding = get_token_encoding(LBO_MODEL)
+    if encoding is None:
+        return text[:max_tokens * 4]  # ~4 characters per token for English text
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
 
-def gpt_extract_financials(raw_text):
-    prompt = f"""
-You are a financial analyst. Extract the following key metrics from this CIM text:
+# Static instructions go first (system message) so the provider can reuse the
+# cached prompt prefix; only the CIM text varies between calls.
+EXTRACTION_INSTRUCTIONS = """
+You are a financial analyst. Extract the following key metrics from the CIM text provided by the user:
 - Revenue for each year (e.g., 2021, 2022, 2023)
 - EBITDA for each year
 - CapEx for each year
 
-Return ONLY a valid JSON object with keys like Revenue_2021, EBITDA_2021, CapEx_2021, etc.
-Use numeric values (not strings) for the financial figures.
+Return one entry per metric and year found in the text.
+Use numeric values in full units (e.g., 100000000 for $100M), not strings.
 If a value is not found, use null.
-
-Example format:
-{{
-    "Revenue_2021": 100000000,
-    "Revenue_2022": 120000000,
-    "Revenue_2023": 140000000,
-    "EBITDA_2021": 25000000,
-    "EBITDA_2022": 30000000,
-    "EBITDA_2023": 35000000,
-    "CapEx_2021": 5000000,
-    "CapEx_2022": 6000000,
-    "CapEx_2023": 7000000
-}}
-
-Text:
-{raw_text[:4000]}  # Only send first 4000 characters for demo
 """
+
+# Structured outputs guarantee the reply parses against this schema, so no
+# markdown-fence or brace scraping is needed
+FINANCIALS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "metrics": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "metric": {"type": "string", "enum": ["Revenue", "EBITDA", "CapEx"]},
+                    "year": {"type": "integer"},
+                    "value": {"type": ["number", "null"]},
+                },
+                "required": ["metric", "year", "value"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["metrics"],
+    "additionalProperties": False,
+}
+
+def gpt_extract_financials(raw_text):
+    # Send the financial lines from the whole document, not just its first page
+    prompt = f"Text:\n{condense_financial_text(raw_text)}"
     
+    model = LBO_MODEL
+    messages = [
+        {"role": "system", "content": EXTRACTION_INSTRUCTIONS},
+        {"role": "user", "content": prompt},
+    ]
+    temperature = 0.1  # Lower temperature for more consistent output
+    
+    llm_cache = get_llm_cache()
+    cached = llm_cache.get(model, messages, temperature)
+    if cached is not None:
+        return cached
+    
+    content = None
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1  # Lower temperature for more consistent output
+        stream = get_openai_client(OPENAI_API_KEY).chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=EXTRACTION_MAX_TOKENS,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "cim_financials", "strict": True, "schema": FINANCIALS_SCHEMA},
+            },
+            stream=True,
         )
-        content = response.choices[0].message.content
         
-        # Clean and parse JSON
-        cleaned_content = clean_json_response(content)
-        return json.loads(cleaned_content)
+        # Render tokens as they arrive so the user sees progress from the first token
+        placeholder = st.empty()
+        parts, refusal = [], []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.refusal:
+                refusal.append(delta.refusal)
+            if delta.content:
+                parts.append(delta.content)
+                placeholder.code("".join(parts), language="json")
+        placeholder.empty()
+        
+        if refusal:
+            st.error(f"GPT declined the request: {''.join(refusal)}")
+            return {}
+        content = "".join(parts)
         
-    except json.JSONDecodeError as e:
+        # Flatten to the Revenue_2021-style keys used as template named ranges
+        metrics = orjson.loads(content)["metrics"]
+        extracted = {f"{m['metric']}_{m['year']}": m["value"] for m in metrics}
+        llm_cache.set(model, messages, temperature, extracted)
+        return extracted
+        
+    except orjson.JSONDecodeError as e:
         st.error(f"JSON parsing error: {e}")
         st.error(f"GPT Response: {content}")
         return {}
@@ -82,37 +210,207 @@ Text:
         st.error(f"Error calling GPT: {e}")
         return {}
 
+# ---- TEMPLATE XML ----
+# The output is produced by patching the template's sheet XML in place rather than
+# round-tripping it through openpyxl, whose save() re-serializes every styled sheet.
+_NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_CALC_CHAIN_PART = "xl/calcChain.xml"
+_NAME_DEST = re.compile(r"^(?:'((?:[^']|'')+)'|([^'!]+))!\$?([A-Z]{1,3})\$?(\d+)$")
+_CELL_COL = re.compile(r'<c\b[^>]*?\br="([A-Z]+)\d+"')
+_ROW_NUM = re.compile(r'<row\b[^>]*?\br="(\d+)"')
+_STYLE_ATTR = re.compile(r'\bs="(\d+)"')
+_CALC_PR = re.compile(r"<calcPr\b([^>]*?)(/?)>")
+_CALC_CHAIN_REL = re.compile(r'<Relationship\b[^>]*?Target="/?(?:xl/)?calcChain\.xml"[^>]*/>')
+_CALC_CHAIN_TYPE = re.compile(r'<Override\b[^>]*?PartName="/xl/calcChain\.xml"[^>]*/>')
+
+@st.cache_resource(show_spinner=False)
+def _load_template_package(path, mtime):
+    """Read the template zip once: raw bytes, parts, sheet part per name, and global defined names"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    with zipfile.ZipFile(BytesIO(raw)) as zf:
+        parts = {info.filename: zf.read(info) for info in zf.infolist()}
+    
+    rels = ElementTree.fromstring(parts["xl/_rels/workbook.xml.rels"])
+    targets = {
+        rel.get("Id"): rel.get("Target").lstrip("/").removeprefix("xl/")
+        for rel in rels.iter(f"{_NS_PKG_REL}Relationship")
+    }
+    workbook = ElementTree.fromstring(parts["xl/workbook.xml"])
+    sheet_parts = {
+        sheet.get("name"): "xl/" + targets[sheet.get(f"{_NS_REL}id")]
+        for sheet in workbook.iter(f"{_NS_MAIN}sheet")
+    }
+    defined_names = {
+        name.get("name"): (name.text or "").strip()
+        for name in workbook.iter(f"{_NS_MAIN}definedName")
+        if name.get("localSheetId") is None
+    }
+    return raw, parts, sheet_parts, defined_names
+
+def load_template_package(path):
+    # Keying on mtime picks up edits to the template file
+    return _load_template_package(path, os.path.getmtime(path))
+
+def resolve_defined_name(destination, sheet_parts):
+    """Return (sheet part, coordinate) for a single-cell named range, else None"""
+    match = _NAME_DEST.match(destination)
+    if not match:
+        return None
+    quoted, plain, col, row = match.groups()
+    sheet = quoted.replace("''", "'") if quoted else plain
+    part = sheet_parts.get(sheet)
+    return (part, f"{col}{row}") if part else None
+
+def _cell_xml(coord, value, style):
+    s_attr = f' s="{style}"' if style else ""
+    if value is None:
+        return f'<c r="{coord}"{s_attr}/>'
+    if isinstance(value, bool):
+        return f'<c r="{coord}"{s_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{coord}"{s_attr}><v>{value!r}</v></c>'
+    text = xml_escape(str(value))
+    return f'<c r="{coord}"{s_attr} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def set_cell_xml(sheet_xml, coord, value):
+    """Write a constant into one cell of a worksheet XML string, keeping its style"""
+    col = coord.rstrip("0123456789")
+    row = int(coord[len(col):])
+    
+    # Find candidates with a plain substring scan and only run the cell regex
+    # there, rather than letting it try every tag in a sheet of hundreds of KB
+    cell_pattern = re.compile(rf'<c\b[^>]*?\br="{coord}"[^>]*?(?:/>|>.*?</c>)', re.DOTALL)
+    existing = None
+    ref = sheet_xml.find(f'r="{coord}"')
+    while ref != -1 and existing is None:
+        existing = cell_pattern.match(sheet_xml, sheet_xml.rfind("<", 0, ref))
+        ref = sheet_xml.find(f'r="{coord}"', ref + 1)
+    if existing:
+        cell = existing.group(0)
+        if 't="shared"' in cell and "ref=" in cell:
+            raise ValueError(f"{coord} anchors a shared formula")
+        style = _STYLE_ATTR.search(cell[:cell.index(">")])
+        new_cell = _cell_xml(coord, value, style.group(1) if style else None)
+        return sheet_xml[:existing.start()] + new_cell + sheet_xml[existing.end():]
+    
+    new_cell = _cell_xml(coord, value, None)
+    row_match = re.search(rf'<row\b[^>]*?\br="{row}"[^>]*?(?:/>|>(.*?)</row>)', sheet_xml, re.DOTALL)
+    if row_match:
+        if row_match.group(1) is None:
+            # Self-closing <row .../> becomes <row ...>cell</row>
+            opening = row_match.group(0)[:-2] + ">"
+            return sheet_xml[:row_match.start()] + opening + new_cell + "</row>" + sheet_xml[row_match.end():]
+        # Keep cells in column order within the row
+        insert_at = row_match.end(1)
+        target_col = column_index_from_string(col)
+        for cell_match in _CELL_COL.finditer(row_match.group(1)):
+            if column_index_from_string(cell_match.group(1)) > target_col:
+                insert_at = row_match.start(1) + cell_match.start()
+                break
+        return sheet_xml[:insert_at] + new_cell + sheet_xml[insert_at:]
+    
+    new_row = f'<row r="{row}">{new_cell}</row>'
+    for row_num in _ROW_NUM.finditer(sheet_xml):
+        if int(row_num.group(1)) > row:
+            return sheet_xml[:row_num.start()] + new_row + sheet_xml[row_num.start():]
+    if "<sheetData/>" in sheet_xml:
+        return sheet_xml.replace("<sheetData/>", f"<sheetData>{new_row}</sheetData>", 1)
+    return sheet_xml.replace("</sheetData>", new_row + "</sheetData>", 1)
+
+def _force_full_recalc(workbook_xml):
+    # Cached results of formulas that depend on the patched cells are stale
+    match = _CALC_PR.search(workbook_xml)
+    if match:
+        attrs = re.sub(r'\s*fullCalcOnLoad="[^"]*"', "", match.group(1))
+        calc_pr = f'<calcPr{attrs} fullCalcOnLoad="1"{match.group(2)}>'
+        return workbook_xml[:match.start()] + calc_pr + workbook_xml[match.end():]
+    return workbook_xml.replace("</workbook>", '<calcPr fullCalcOnLoad="1"/></workbook>', 1)
+
+def write_template_package(parts, patched_sheets):
+    """Zip the template back up with patched sheets; the calc chain is dropped for Excel to rebuild"""
+    output = BytesIO()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zout:
+        for name, data in parts.items():
+            if name == _CALC_CHAIN_PART:
+                continue
+            if name in patched_sheets:
+                data = patched_sheets[name].encode("utf-8")
+            elif name == "xl/workbook.xml":
+                data = _force_full_recalc(data.decode("utf-8")).encode("utf-8")
+            elif name == "xl/_rels/workbook.xml.rels":
+                data = _CALC_CHAIN_REL.sub("", data.decode("utf-8")).encode("utf-8")
+            elif name == "[Content_Types].xml":
+                data = _CALC_CHAIN_TYPE.sub("", data.decode("utf-8")).encode("utf-8")
+            zout.writestr(name, data)
+    return output
+
+def build_output_workbook(extracted_data):
+    """Write extracted values to a fresh workbook in write-only (streaming) mode"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Model")
+    header = []
+    for title in ("Metric", "Value"):
+        cell = WriteOnlyCell(ws, value=title)
+        cell.font = Font(bold=True)
+        header.append(cell)
+    ws.append(header)
+    for key, value in extracted_data.items():
+        ws.append([key, value])
+    
+    output = BytesIO()
+    wb.save(output)
+    return output
+
+def summarize_issues(items, limit=MAX_LISTED_ISSUES):
+    shown = ", ".join(items[:limit])
+    if len(items) > limit:
+        shown += f" (+{len(items) - limit} more)"
+    return shown
+
 def fill_excel_template(extracted_data):
     try:
-        wb = openpyxl.load_workbook(TEMPLATE_PATH)
-        ws = wb["Model"]  # Assume data goes in 'Model' sheet
+        raw, parts, sheet_parts, defined_names = load_template_package(TEMPLATE_PATH)
         
         # Map keys to named ranges (you can also hardcode cell names here)
+        patched_sheets = {}
         mapped_count = 0
+        unmapped, failed = [], []
         for key, value in extracted_data.items():
+            destination = defined_names.get(key)
+            if destination is None:
+                # If no named range, you could add hardcoded cell mappings here
+                unmapped.append(key)
+                continue
             try:
-                # Try to find named range
-                if key in wb.defined_names:
-                    cell = wb.defined_names[key].destinations
-                    for title, coord in cell:
-                        target_ws = wb[title]
-                        target_ws[coord] = value
-                        mapped_count += 1
-                else:
-                    # If no named range, you could add hardcoded cell mappings here
-                    st.warning(f"No named range found for: {key}")
+                target = resolve_defined_name(destination, sheet_parts)
+                if target is None:
+                    raise ValueError(f"{destination} is not a single cell")
+                part, coord = target
+                if part not in patched_sheets:
+                    patched_sheets[part] = parts[part].decode("utf-8")
+                patched_sheets[part] = set_cell_xml(patched_sheets[part], coord, value)
+                mapped_count += 1
             except Exception as e:
-                st.warning(f"Could not map {key}: {e}")
+                failed.append(f"{key} ({e})")
         
+        # One warning per kind instead of one element per key
+        if unmapped:
+            st.warning(f"No named range found for: {summarize_issues(unmapped)}")
+        if failed:
+            st.warning(f"Could not map: {summarize_issues(failed)}")
         st.success(f"Successfully mapped {mapped_count} values to Excel template")
         
-        output = BytesIO()
-        wb.save(output)
-        return output
+        if not patched_sheets:
+            return BytesIO(raw)
+        return write_template_package(parts, patched_sheets)
         
     except FileNotFoundError:
-        st.error(f"Excel template not found: {TEMPLATE_PATH}")
-        return None
+        # No template to populate, so stream the values into a plain workbook instead
+        st.warning(f"Excel template not found: {TEMPLATE_PATH}. Exporting extracted values only.")
+        return build_output_workbook(extracted_data)
     except Exception as e:
         st.error(f"Error processing Excel template: {e}")
         return None
@@ -127,8 +425,12 @@ This tool extracts financial data from CIM PDFs and populates an Excel LBO templ
 uploaded_file = st.file_uploader("Upload CIM PDF", type="pdf")
 
 if uploaded_file:
+    # Read the upload once; the same bytes feed the hash and the parser
+    file_bytes = uploaded_file.getvalue()
+    file_key = hashlib.sha256(file_bytes).hexdigest()
+    
     with st.spinner("Extracting text from PDF..."):
-        raw_text = extract_text_from_pdf(uploaded_file)
+        raw_text = extract_text_from_pdf(file_key, file_bytes)
     
     st.subheader("Extracted Text Preview")
     st.text_area("Preview (first 1000 characters)", raw_text[:1000], height=200)
@@ -137,18 +439,30 @@ if uploaded_file:
         with st.spinner("Analyzing document with GPT..."):
             extracted_data = gpt_extract_financials(raw_text)
         
+        output_excel = None
         if extracted_data:
-            st.subheader("Extracted Financial Data")
-            st.json(extracted_data)
-            
             with st.spinner("Populating Excel template..."):
                 output_excel = fill_excel_template(extracted_data)
+        
+        # Keep results for this upload so later reruns (e.g. the download click)
+        # redisplay them instead of dropping them or re-running the pipeline
+        st.session_state["results"] = {
+            "file_key": file_key,
+            "extracted_data": extracted_data,
+            "output_excel": output_excel.getvalue() if output_excel else None,
+        }
+    
+    results = st.session_state.get("results")
+    if results and results["file_key"] == file_key:
+        if results["extracted_data"]:
+            st.subheader("Extracted Financial Data")
+            st.json(results["extracted_data"])
             
-            if output_excel:
+            if results["output_excel"]:
                 st.success("Excel template populated successfully!")
                 st.download_button(
                     label="Download Populated Model",
-                    data=output_excel.getvalue(),
+                    data=results["output_excel"],
                     file_name="lbo_filled.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )